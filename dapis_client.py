@@ -7,7 +7,7 @@ FastAPIサーバーに対象パスを送信し、ブラウザで検索画面を
 
 import sys
 import os
-import json
+import orjson
 import uuid
 import subprocess
 import platform
@@ -25,7 +25,7 @@ sid = str(uuid.uuid4())
 
 # JSON生成
 data = {"session_id": sid, "paths": paths}
-json_data = json.dumps(data).encode("utf-8")
+json_data = orjson.dumps(data)
 
 # POSTリクエスト送信
 req = urllib.request.Request(
@@ -37,10 +37,12 @@ req = urllib.request.Request(
 
 try:
     with urllib.request.urlopen(req) as resp:
-        resp_json = json.load(resp)
+        resp_json = orjson.loads(resp.read())
         if not resp_json.get("ok"):
             print("Failed to submit targets:", resp_json)
             sys.exit(1)
+        for p in resp_json.get("rejected", []):
+            print("Skipped (not found / not a file):", p)
 except Exception as e:
     print("Failed to submit targets:", e)
     sys.exit(1)